@@ -2,12 +2,12 @@ import unittest
 import psycopg2
 import psycopg2.extras;
 import cStringIO
+import itertools
 import logging
-import pprint
 import psycopg2.extensions
 import select
+import struct
 import time
-import sys
 import os
 from pglogical_protoreader import ProtocolReader
 from pglogical_protovalidator import ProtocolValidator
@@ -16,6 +16,28 @@ from pglogical_proto import ReplicationMessage
 
 SLOT_NAME = 'test'
 
+BINARY_COPY_SIGNATURE = 'PGCOPY\n\377\r\n\0'
+
+def read_binary_copy(f):
+    """
+    Read COPY ... WITH (FORMAT binary) output from file-like f, yielding
+    each row as a tuple of raw field values (None for NULLs).
+    """
+    if f.read(len(BINARY_COPY_SIGNATURE)) != BINARY_COPY_SIGNATURE:
+        raise ValueError("Missing binary COPY signature")
+    flags, extlen = struct.unpack("!iI", f.read(8))
+    f.read(extlen)
+
+    while True:
+        nfields = struct.unpack("!h", f.read(2))[0]
+        if nfields == -1:
+            return
+        row = []
+        for i in xrange(nfields):
+            fieldlen = struct.unpack("!i", f.read(4))[0]
+            row.append(None if fieldlen == -1 else f.read(fieldlen))
+        yield tuple(row)
+
 class BaseDecodingInterface(object):
     """Helper for handling the different decoding interfaces"""
 
@@ -53,6 +75,9 @@ class BaseDecodingInterface(object):
                 $$
                 DECLARE
                     timeleft float := 5.0;
+                    -- Usually the slot frees up almost at once, so start polling
+                    -- quickly and back off from there.
+                    pollinterval float := 0.01;
                     _slotname name := %s;
                 BEGIN
                     IF NOT EXISTS (SELECT 1 FROM pg_catalog.pg_replication_slots WHERE slot_name = _slotname)
@@ -61,8 +86,9 @@ class BaseDecodingInterface(object):
                     END IF;
                     WHILE (SELECT active FROM pg_catalog.pg_replication_slots WHERE slot_name = _slotname) AND timeleft > 0
                     LOOP
-                        PERFORM pg_sleep(0.1);
-                        timeleft := timeleft - 0.1;
+                        PERFORM pg_sleep(pollinterval);
+                        timeleft := timeleft - pollinterval;
+                        pollinterval := least(pollinterval * 2, 0.1);
                     END LOOP;
                     IF timeleft > 0 THEN
                         PERFORM pg_drop_replication_slot(_slotname);
@@ -90,15 +116,21 @@ class BaseDecodingInterface(object):
                 'startup_params_format': '1'
                 }
         params_dict.update(kwargs)
-        return params_dict
+        # A value of None means "don't send this option at all"
+        return {k: v for k, v in params_dict.iteritems() if v is not None}
 
 
 
 class SQLDecodingInterface(BaseDecodingInterface):
     """Use the SQL level logical decoding interfaces"""
 
+    fetch_size = 1000
+
     def __init__(self, connstring, parentlogger=logging.getLogger('base')):
         BaseDecodingInterface.__init__(self, connstring, logger=parentlogger.getChild('sqldecoding:%s' % hex(id(self))))
+        self._params_cache = {}
+        self._open_readers = 0
+        self._reader_serial = 0
 
         # cleanup old slot
         if self.slot_exists():
@@ -109,24 +141,101 @@ class SQLDecodingInterface(BaseDecodingInterface):
 
     def cleanup(self):
         self.logger.debug("Closing sql decoding connection")
+        # A partially consumed get_changes() generator may have left its
+        # transaction open; end it so the slot drop runs in autocommit.
+        if self.conn is not None and not self.conn.closed:
+            self.conn.rollback()
+            self.conn.autocommit = True
+        self._open_readers = 0
         self.drop_slot_when_inactive()
         BaseDecodingInterface.cleanup(self)
         self.logger.debug("Closed sql decoding connection")
 
-    def get_changes(self, kwargs = {}):
-        params_dict = self._get_changes_params(kwargs)
+    def _get_changes_array(self, kwargs):
+        # Tests tend to ask for the same options over and over, so only
+        # build the options array once for each distinct set of kwargs.
+        # It's formatted as a text[] literal so psycopg2 has a single
+        # string to quote, not a list of every key and value.
+        cache_key = frozenset(kwargs.iteritems())
+        params = self._params_cache.get(cache_key)
+        if params is None:
+            params_dict = self._get_changes_params(kwargs)
+            params = "{%s}" % ",".join(
+                '"%s"' % str(i).replace('\\', '\\\\').replace('"', '\\"')
+                for i in itertools.chain.from_iterable(params_dict.iteritems()))
+            self._params_cache[cache_key] = params
+        return params
 
-        # Filter out entries with value None
-        params = [i for k, v in params_dict.items() for i in [k,str(v)] if v is not None]
-        # and create the slot
+    def get_changes(self, kwargs = {}):
+        params = self._get_changes_array(kwargs)
+
+        # Read the changes through a server-side cursor in batches of
+        # fetch_size rows rather than buffering them all at once. Named
+        # cursors only live within a transaction, so we have to leave
+        # autocommit mode while any get_changes() generator is live. Callers
+        # may hold more than one at a time, so each gets its own cursor in
+        # the shared transaction and the last one out ends it.
+        if self._open_readers == 0:
+            self.conn.autocommit = False
+        self._open_readers += 1
+        self._reader_serial += 1
+        changes_cur = self.conn.cursor(name='pglogical_changes_%d' % self._reader_serial, withhold=False)
         try:
-            self.cur.execute("SELECT * FROM pg_logical_slot_get_binary_changes(%s, NULL, NULL" + (", %s" * len(params)) + ")",
-                    [SLOT_NAME] + params);
+            # pass the options as a single text[] literal, rather than one
+            # placeholder per key and value
+            changes_cur.execute("SELECT * FROM pg_logical_slot_get_binary_changes(%(slot)s, NULL, NULL, VARIADIC %(opts)s::text[])",
+                    {'slot': SLOT_NAME, 'opts': params})
+
+            while True:
+                rows = changes_cur.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield ReplicationMessage(row)
         finally:
-            self.conn.commit()
+            # cleanup() may already have closed the connection if the
+            # caller didn't consume all the changes.
+            if not self.conn.closed:
+                self._open_readers -= 1
+                status = self.conn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+                    changes_cur.close()
+                    if self._open_readers == 0:
+                        self.conn.commit()
+                elif status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                    # Any other live reader's cursor is gone with it anyway
+                    self.conn.rollback()
+                if self._open_readers == 0:
+                    self.conn.autocommit = True
+
+    def peek_changes(self, kwargs = {}):
+        """
+        Return the changes pending on the slot as raw (lsn, xid, data) rows,
+        as the row path sees them, without consuming them.
+        """
+        self.cur.execute("SELECT * FROM pg_logical_slot_peek_binary_changes(%(slot)s, NULL, NULL, VARIADIC %(opts)s::text[])",
+                {'slot': SLOT_NAME, 'opts': self._get_changes_array(kwargs)})
+        return self.cur.fetchall()
 
-        for row in self.cur:
-            yield ReplicationMessage(row)
+    def get_changes_bulk(self, kwargs = {}):
+        """
+        Like get_changes(), but drain everything pending on the slot at once
+        with a binary COPY, which has less per-row overhead than a query
+        result.
+        """
+        params = self._get_changes_array(kwargs)
+
+        query = self.cur.mogrify("COPY (SELECT * FROM pg_logical_slot_get_binary_changes(%(slot)s, NULL, NULL, VARIADIC %(opts)s::text[])) TO STDOUT WITH (FORMAT binary)",
+                {'slot': SLOT_NAME, 'opts': params})
+        buf = cStringIO.StringIO()
+        self.cur.copy_expert(query, buf)
+        buf.seek(0)
+
+        for (lsn, xid, data) in read_binary_copy(buf):
+            # Present lsn and xid the way the row path returns them
+            lsn = struct.unpack("!Q", lsn)[0]
+            yield ReplicationMessage(("%X/%X" % (lsn >> 32, lsn & 0xFFFFFFFF),
+                    str(struct.unpack("!I", xid)[0]), data))
 
 
 
@@ -135,6 +244,7 @@ class WalsenderDecodingInterface(BaseDecodingInterface):
 
     walcur = None
     walconn = None
+    walpoll = None
     select_timeout = 1
     replication_started = False
 
@@ -147,6 +257,11 @@ class WalsenderDecodingInterface(BaseDecodingInterface):
         self.logger.debug("Acquired replication connection with pid %s", self.walconn.get_backend_pid())
         self.walcur = self.walconn.cursor()
 
+        # get_changes() waits on this socket for every batch of messages,
+        # so register it with a poll object once up front.
+        self.walpoll = select.poll()
+        self.walpoll.register(self.walconn.fileno(), select.POLLIN)
+
         # clean up old slot
         if self.slot_exists():
                 self.walcur.drop_replication_slot(SLOT_NAME)
@@ -160,6 +275,8 @@ class WalsenderDecodingInterface(BaseDecodingInterface):
     def cleanup(self):
         self.logger.debug("Closing walsender connection")
 
+        # poll objects hold no OS resources; just forget it
+        self.walpoll = None
         if self.walcur is not None:
             self.walcur.close()
         if self.walconn is not None:
@@ -172,30 +289,29 @@ class WalsenderDecodingInterface(BaseDecodingInterface):
         self.logger.debug("Closed walsender connection")
 
     def get_changes(self, kwargs = {}):
-        params_dict = self._get_changes_params(kwargs)
-
+        # Options can only be passed when replication starts, so there's
+        # no point building them on later calls.
         if not self.replication_started:
-            self.walcur.start_replication(slot_name=SLOT_NAME,
-                    options={k: v for k, v in params_dict.iteritems() if v is not None})
+            params_dict = self._get_changes_params(kwargs)
+            self.walcur.start_replication(slot_name=SLOT_NAME, options=params_dict)
             self.replication_started = True
         try:
             while True:
                 # There's never any "done" or "last message", so just keep
-                # reading as long as the caller asks. If select times out,
+                # reading as long as the caller asks. If poll times out,
                 # a normal client would send feedback. We'll treat it as a
                 # failure instead, since the caller asked for a message we
                 # are apparently not going to receive.
                 message = self.walcur.read_replication_message(decode=False)
                 if message is None:
-                    self.logger.debug("No message pending, select()ing with timeout %s", self.select_timeout)
-                    sel = select.select([self.walcur], [], [], self.select_timeout)
-                    if not sel[0]:
+                    self.logger.debug("No message pending, polling with timeout %s", self.select_timeout)
+                    if not self.walpoll.poll(self.select_timeout * 1000):
                         raise IOError("Server didn't send an expected message before timeout")
                 else:
-                    if len(message.payload) < 200:
-                        self.logger.debug("payload: %s", repr(message.payload))
-                    else:
-                        self.logger.debug("payload (truncated): %s...", repr(message.payload)[:200])
+                    # Don't repr() every payload unless someone will see it
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug("payload at %s, %d bytes: %r", message.data_start,
+                                len(message.payload), message.payload[:200])
                     yield ReplicationMessage((message.data_start, None, message.payload))
         except psycopg2.InternalError, ex:
             self.logger.debug("While retrieving a message: sqlstate=%s", ex.pgcode, exc_info=True)
@@ -207,6 +323,28 @@ class PGLogicalOutputTest(unittest.TestCase):
 
     connstring = "dbname=postgres host=localhost"
     interface = None
+    conn = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.connect_sql()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.conn is not None:
+            cls.conn.close()
+            cls.conn = None
+
+    @classmethod
+    def connect_sql(cls):
+        """
+        Get the connection for test classes to use to run SQL.
+
+        It's shared by all the tests in the class rather than made afresh
+        for each one; tearDown() resets it between tests.
+        """
+        cls.conn = psycopg2.connect(cls.connstring, connection_factory=psycopg2.extras.LoggingConnection)
+        cls.conn.initialize(logging.getLogger(cls.__name__).getChild('sql'))
 
     def setUp(self):
         # A counter we can increment each time we reconnet with decoding,
@@ -215,15 +353,20 @@ class PGLogicalOutputTest(unittest.TestCase):
 
         # Set up our logger
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.loghandler = logging.StreamHandler()
-        for handler in self.logger.handlers:
-            self.logger.removeHandler(handler)
-        self.logger.addHandler(self.loghandler)
+        # Tests in the same class share a logger, so only add a handler
+        # the first time round and reuse it after that.
+        if not self.logger.handlers:
+            self.logger.addHandler(logging.StreamHandler())
+        self.loghandler = self.logger.handlers[0]
+        self.loghandler.setFormatter(None)
         self.logger.setLevel(os.environ.get('PGLOGICALTEST_LOGLEVEL', 'INFO'))
 
-        # Get connections for test classes to use to run SQL
-        self.conn = psycopg2.connect(self.connstring, connection_factory=psycopg2.extras.LoggingConnection)
-        self.conn.initialize(self.logger.getChild('sql'))
+        # A previous test may have lost the shared connection, or failed
+        # in its own tearDown before ours could roll back.
+        if self.conn.closed:
+            self.connect_sql()
+        else:
+            self.conn.rollback()
         self.cur = self.conn.cursor()
 
         if hasattr(self, 'set_up'):
@@ -233,8 +376,12 @@ class PGLogicalOutputTest(unittest.TestCase):
         if hasattr(self, 'tear_down'):
             self.tear_down()
 
-        if self.conn is not None:
-            self.conn.close()
+        # Leave the shared connection as we'd find a new one
+        if not self.conn.closed:
+            self.conn.rollback()
+            self.cur.execute("DISCARD TEMP")
+            self.conn.commit()
+            self.cur.close()
 
     def doCleanups(self):
         if self.interface:
@@ -285,3 +432,15 @@ class PGLogicalOutputTest(unittest.TestCase):
         msg_gen = self.interface.get_changes(kwargs)
         return ProtocolReader(msg_gen, validator = ProtocolValidator(),
                                tester=self, parentlogger=self.logger)
+
+    def get_changes_bulk(self, kwargs = {}):
+        """
+        Like get_changes(), but drain the slot in one go via the SQL
+        interface's get_changes_bulk().
+        """
+        if self.interface is None:
+            raise ValueError("No logical decoding connection. Call connect_decoding()")
+
+        msg_gen = self.interface.get_changes_bulk(kwargs)
+        return ProtocolReader(msg_gen, validator = ProtocolValidator(),
+                               tester=self, parentlogger=self.logger)
@@ -6,40 +6,20 @@ class UnchangedField(object):
     """Opaque placeholder object for a TOASTed field that didn't change"""
     pass
 
-def readcstr(f):
-    buf = bytearray()
-    while True:
-        b = f.read(1)
-        if b is None or len(b) == 0:
-            if len(buf) == 0:
-                return None
-            else:
-                raise ValueError("non-terminated string at EOF")
-        elif b is '\0':
-            return str(buf)
-        else:
-            buf.append(b)
+# Precompiled formats for the fields read for every row
+uint16 = struct.Struct("!H")
+uint32 = struct.Struct("!I")
 
 class ReplicationMessage(object):
+    # One of these is created for every message decoded, so don't give
+    # each of them an instance dict.
+    __slots__ = ('lsn', 'xid', 'msg')
+
     def __new__(cls, msg):
         msgtype = msg[2][0]
-        if msgtype == "S":
-            cls = StartupMessage
-        elif msgtype == "B":
-            cls = BeginMessage
-        elif msgtype == "C":
-            cls = CommitMessage
-        elif msgtype == "O":
-            cls = OriginMessage
-        elif msgtype == "R":
-            cls = RelationMessage
-        elif msgtype == "I":
-            cls = InsertMessage
-        elif msgtype == "U":
-            cls = UpdateMessage
-        elif msgtype == "D":
-            cls = DeleteMessage
-        else:
+        try:
+            cls = MESSAGE_TYPES[msgtype]
+        except KeyError:
             raise Exception("Unknown message type %s", msgtype)
 
         return super(ReplicationMessage, cls).__new__(cls)
@@ -62,7 +42,7 @@ class ReplicationMessage(object):
 
     def parse_tuple(self, msg):
         assert msg.read(1) == "T"
-        numcols = struct.unpack("!H", msg.read(2))[0]
+        numcols = uint16.unpack(msg.read(2))[0]
 
         cols = []
         for i in xrange(0, numcols):
@@ -73,18 +53,20 @@ class ReplicationMessage(object):
                 cols.append(UnchangedField())
             else:
                 assert typ in ('i','b','t') #typ should be 'i'nternal-binary, 'b'inary, 't'ext
-                datalen = struct.unpack("!I", msg.read(4))[0]
+                datalen = uint32.unpack(msg.read(4))[0]
                 cols.append(msg.read(datalen))
 
         return cols
 
 class ChangeMessage(ReplicationMessage):
-    pass
+    __slots__ = ()
 
 class TransactionMessage(ReplicationMessage):
-    pass
+    __slots__ = ()
 
 class StartupMessage(ReplicationMessage):
+    __slots__ = ()
+
     @property
     def message(self):
         res = {"type": "S"}
@@ -94,20 +76,19 @@ class StartupMessage(ReplicationMessage):
         res['startup_msg_version'] = struct.unpack("b", msg.read(1))[0]
         # Now split the null-terminated k/v strings
         # and store as a dict, since we don't care about order.
-        params = {}
-        while True:
-            k = readcstr(msg)
-            if k is None:
-                break;
-            v = readcstr(msg)
-            if (v is None):
-                raise ValueError("Value for key %s missing, read key as last entry" % k)
-            params[k] = v
+        fields = msg.read().split('\0')
+        if fields.pop() != '':
+            raise ValueError("non-terminated string at EOF")
+        if len(fields) % 2 != 0:
+            raise ValueError("Value for key %s missing, read key as last entry" % fields[-1])
+        params = dict(zip(fields[0::2], fields[1::2]))
         res['params'] = params
 
         return res
 
 class BeginMessage(TransactionMessage):
+    __slots__ = ()
+
     @property
     def message(self):
         res = {"type": "B"}
@@ -124,6 +105,8 @@ class BeginMessage(TransactionMessage):
         return res
 
 class OriginMessage(ReplicationMessage):
+    __slots__ = ()
+
     @property
     def message(self):
         res = {"type": "O"}
@@ -139,6 +122,8 @@ class OriginMessage(ReplicationMessage):
         return res
 
 class RelationMessage(ReplicationMessage):
+    __slots__ = ()
+
     @property
     def message(self):
         res = {"type": "R"}
@@ -154,7 +139,7 @@ class RelationMessage(ReplicationMessage):
         res['relation'] = msg.read(namelen)
 
         assert msg.read(1) == "A" # attributes
-        numcols = struct.unpack("!H", msg.read(2))[0]
+        numcols = uint16.unpack(msg.read(2))[0]
 
         cols = []
         for i in xrange(0, numcols):
@@ -162,7 +147,7 @@ class RelationMessage(ReplicationMessage):
             msg.read(1) # flags
             assert msg.read(1) == "N" # name
 
-            namelen = struct.unpack("!H", msg.read(2))[0]
+            namelen = uint16.unpack(msg.read(2))[0]
             cols.append(msg.read(namelen))
 
         res["columns"] = cols
@@ -170,6 +155,8 @@ class RelationMessage(ReplicationMessage):
         return res
 
 class CommitMessage(TransactionMessage):
+    __slots__ = ()
+
     @property
     def message(self):
         res = {"type": "C"}
@@ -186,6 +173,8 @@ class CommitMessage(TransactionMessage):
         return res
 
 class InsertMessage(ChangeMessage):
+    __slots__ = ()
+
     @property
     def message(self):
         res = {"type": "I"}
@@ -194,7 +183,7 @@ class InsertMessage(ChangeMessage):
         msg.read(1) # 'I'
         msg.read(1) # flags
 
-        res["relid"] = struct.unpack("!I", msg.read(4))[0]
+        res["relid"] = uint32.unpack(msg.read(4))[0]
 
         assert msg.read(1) == "N"
         res["newtup"] = self.parse_tuple(msg)
@@ -202,6 +191,8 @@ class InsertMessage(ChangeMessage):
         return res
 
 class UpdateMessage(ChangeMessage):
+    __slots__ = ()
+
     @property
     def message(self):
         res = {"type": "U"}
@@ -210,7 +201,7 @@ class UpdateMessage(ChangeMessage):
         msg.read(1) # 'I'
         msg.read(1) # flags
 
-        res["relid"] = struct.unpack("!I", msg.read(4))[0]
+        res["relid"] = uint32.unpack(msg.read(4))[0]
 
         tuptyp = msg.read(1)
         if tuptyp == "K":
@@ -223,6 +214,8 @@ class UpdateMessage(ChangeMessage):
         return res
 
 class DeleteMessage(ChangeMessage):
+    __slots__ = ()
+
     @property
     def message(self):
         res = {"type": "D"}
@@ -231,10 +224,20 @@ class DeleteMessage(ChangeMessage):
         msg.read(1) # 'I'
         msg.read(1) # flags
 
-        res["relid"] = struct.unpack("!I", msg.read(4))[0]
+        res["relid"] = uint32.unpack(msg.read(4))[0]
 
         assert msg.read(1) == "K"
         res["keytup"] = self.parse_tuple(msg)
 
         return res
 
+MESSAGE_TYPES = {
+    "S": StartupMessage,
+    "B": BeginMessage,
+    "C": CommitMessage,
+    "O": OriginMessage,
+    "R": RelationMessage,
+    "I": InsertMessage,
+    "U": UpdateMessage,
+    "D": DeleteMessage,
+}